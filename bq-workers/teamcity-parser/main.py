@@ -12,19 +12,67 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import base64
-from datetime import datetime
 import os
-import json
+import threading
+import traceback
+
+import orjson
+import pybase64
+import simdjson
 
 import shared
 
 from flask import Flask, request
 
-from google.cloud import bigquery
-
 app = Flask(__name__)
 
+_TYPES = frozenset({"buildFinished"})
+
+# Supported event types as they appear in the raw JSON payload
+_TYPE_MARKERS = tuple(('"%s"' % t).encode("utf-8") for t in _TYPES)
+
+# TeamCity build fields that are not needed downstream
+_REDUNDANT_KEYS = frozenset({
+    "agentHostname",
+    "agentName",
+    "agentOs",
+    "branch",
+    "branchDisplayName",
+    "branchIsDefault",
+    "branchName",
+    "buildExternalTypeId",
+    "buildFullName",
+    "buildInternalTypeId",
+    "buildIsPersonal",
+    "buildName",
+    "buildResultDelta",
+    "buildResultPrevious",
+    "buildRunners",
+    "buildStateDescription",
+    "buildStatus",
+    "buildStatusHtml",
+    "buildStatusUrl",
+    "buildTags",
+    "buildTypeId",
+    "changeFileListCount",
+    "extraParameters",
+    "derivedBuildEventType",
+    "maxChangeFileListCountExceeded",
+    "maxChangeFileListSize",
+    "message",
+    "rootUrl",
+    "projectExternalId",
+    "projectId",
+    "projectInternalId",
+    "teamcityProperties",
+    "text",
+    "triggeredBy",
+})
+
+# simdjson parsers reuse their buffers between documents, so each
+# gunicorn thread gets its own
+_local = threading.local()
+
 
 @app.route("/", methods=["POST"])
 def index():
@@ -32,30 +80,43 @@ def index():
     Receives messages from a push subscription from Pub/Sub.
     Parses the message, and inserts it into BigQuery.
     """
-    event = None
-    envelope = request.get_json()
+    envelope = request.get_json(silent=True)
+
+    # Pub/Sub push treats any response other than 102, 200, 201, 202 or 204
+    # as a nack and redelivers the message, 400s included. The 400s below
+    # are only for requests that are not Pub/Sub pushes at all, which a
+    # real push subscription never sends.
 
     # Check that data has been posted
     if not envelope:
-        raise Exception("Expecting JSON payload")
+        return "Expecting JSON payload", 400
     # Check that message is a valid pub/sub message
-    if "message" not in envelope:
-        raise Exception("Not a valid Pub/Sub Message")
-    msg = envelope["message"]
-
-    if "attributes" not in msg:
-        raise Exception("Missing pubsub attributes")
-
+    msg = envelope.get("message") if isinstance(envelope, dict) else None
+    if msg is None:
+        return "Not a valid Pub/Sub Message", 400
+
+    attr = msg.get("attributes") if isinstance(msg, dict) else None
+    if not isinstance(attr, dict):
+        return "Missing pubsub attributes", 400
+
+    # Only TeamCity webhook events are processed. Anything else, including
+    # unreadable headers, is acked with 204 so it is not redelivered.
+    headers = attr.get("headers")
+    if not headers:
+        return "", 204
     try:
-        attr = msg["attributes"]
+        headers = orjson.loads(headers)
+    except orjson.JSONDecodeError:
+        return "", 204
+    if not isinstance(headers, dict) or "X-Tcwebhooks-Request-Id" not in headers:
+        return "", 204
 
-        # Header Event info
-        if "headers" in attr:
-            headers = json.loads(attr["headers"])
+    try:
+        event = process_teamcity_event(msg)
 
-            # Process TeamCity Events
-            if "X-Tcwebhooks-Request-Id" in headers:
-                event = process_teamcity_event(msg)
+        # Unsupported TeamCity events are acknowledged without being saved
+        if event is None:
+            return "", 204
 
         shared.insert_row_into_bigquery(event)
 
@@ -64,70 +125,41 @@ def index():
                 "severity": "WARNING",
                 "msg": "Data not saved to BigQuery",
                 "errors": str(e),
+                "stack_trace": traceback.format_exc(),
                 "json_payload": envelope
             }
-        print(json.dumps(entry))
+        print(orjson.dumps(entry).decode())
 
     return "", 204
 
 
 def process_teamcity_event(msg):
-    # Unique hash for the event
+    data = pybase64.b64decode(msg["data"], validate=True)
+
+    # Skip parsing payloads that cannot contain a supported event type
+    if not any(marker in data for marker in _TYPE_MARKERS):
+        return None
+
+    # Unique hash for the event. This hashes the still-encoded message,
+    # so the payload above is the only base64 decode per request.
     signature = shared.create_unique_id(msg)
     source = "teamcity"
-    
-    types = {"buildFinished"}
-
-    redundant_keys = [
-        "agentHostname",
-        "agentName",
-        "agentOs",
-        "branch",
-        "branchDisplayName",
-        "branchIsDefault",
-        "branchName",
-        "buildExternalTypeId",
-        "buildFullName",
-        "buildInternalTypeId",
-        "buildIsPersonal",
-        "buildName",
-        "buildResultDelta",
-        "buildResultPrevious",
-        "buildRunners",
-        "buildStateDescription",
-        "buildStatus",
-        "buildStatusHtml",
-        "buildStatusUrl",
-        "buildTags",
-        "buildTypeId",
-        "changeFileListCount",
-        "extraParameters",
-        "derivedBuildEventType",
-        "maxChangeFileListCountExceeded",
-        "maxChangeFileListSize",
-        "message",
-        "rootUrl",
-        "projectExternalId",
-        "projectId",
-        "projectInternalId",
-        "teamcityProperties",
-        "text",
-        "triggeredBy",
-    ]
-
-    metadata = json.loads(base64.b64decode(msg["data"]).decode("utf-8").strip())["build"]
-    #print(metadata)
-
-    event_type = metadata["notifyType"]
-
-    if event_type not in types:
-        raise Exception("Unsupported TeamCity event: '%s'" % event_type)
-    
-    for key in redundant_keys:
-        if key in metadata:
-            metadata.pop(key, None)
-    
-    metadata["changes"] = [x["version"] for x in metadata["changes"] if x["change"]["vcsRoot"] != "deployments"]
+
+    build = _get_parser().parse(data)["build"]
+
+    event_type = build["notifyType"]
+
+    if event_type not in _TYPES:
+        return None
+
+    # Only the retained fields are converted to Python objects
+    metadata = {
+        k: _materialize(build[k])
+        for k in build.keys()
+        if k not in _REDUNDANT_KEYS and k != "changes"
+    }
+    # Read each change's version and VCS root without converting its file list
+    metadata["changes"] = [x["version"] for x in build["changes"] if x["change"]["vcsRoot"] != "deployments"]
 
     if event_type in ("buildFinished"):
         e_id = metadata["buildId"]
@@ -136,21 +168,34 @@ def process_teamcity_event(msg):
     teamcity_event = {
         "event_type": event_type,
         "id": e_id,
-        "metadata": json.dumps(metadata),
+        "metadata": orjson.dumps(metadata).decode(),
         "time_created": msg["publishTime"],
         "signature": signature,
         "msg_id": msg["message_id"],
         "source": source,
     }
 
-    print(teamcity_event)
-
     return teamcity_event
 
 
+def _get_parser():
+    parser = getattr(_local, "parser", None)
+    if parser is None:
+        parser = _local.parser = simdjson.Parser()
+    return parser
+
+
+def _materialize(value):
+    if isinstance(value, simdjson.Object):
+        return value.as_dict()
+    if isinstance(value, simdjson.Array):
+        return value.as_list()
+    return value
+
+
 if __name__ == "__main__":
     PORT = int(os.getenv("PORT")) if os.getenv("PORT") else 8080
 
     # This is used when running locally. Gunicorn is used to run the
     # application on Cloud Run. See entrypoint in Dockerfile.
-    app.run(host="127.0.0.1", port=PORT, debug=True)
+    app.run(host="127.0.0.1", port=PORT)
@@ -29,35 +29,41 @@ def client():
 
 
 def test_not_json(client):
-    with pytest.raises(Exception) as e:
-        client.post("/", data="foo")
+    r = client.post("/", data="foo")
 
-    assert "Expecting JSON payload" in str(e.value)
+    assert r.status_code == 400
+    assert b"Expecting JSON payload" in r.data
 
 
-def test_not_pubsub_message(client):
-    with pytest.raises(Exception) as e:
-        client.post(
-            "/",
-            data=json.dumps({"foo": "bar"}),
-            headers={"Content-Type": "application/json"},
-        )
+@pytest.mark.parametrize(
+    "envelope", [{"foo": "bar"}, [1], 5, "x"],
+)
+def test_not_pubsub_message(client, envelope):
+    r = client.post(
+        "/",
+        data=json.dumps(envelope),
+        headers={"Content-Type": "application/json"},
+    )
 
-    assert "Not a valid Pub/Sub Message" in str(e.value)
+    assert r.status_code == 400
+    assert b"Not a valid Pub/Sub Message" in r.data
 
 
-def test_missing_msg_attributes(client):
-    with pytest.raises(Exception) as e:
-        client.post(
-            "/",
-            data=json.dumps({"message": "bar"}),
-            headers={"Content-Type": "application/json"},
-        )
+@pytest.mark.parametrize(
+    "message", ["bar", {}, {"attributes": "foo"}],
+)
+def test_missing_msg_attributes(client, message):
+    r = client.post(
+        "/",
+        data=json.dumps({"message": message}),
+        headers={"Content-Type": "application/json"},
+    )
 
-    assert "Missing pubsub attributes" in str(e.value)
+    assert r.status_code == 400
+    assert b"Missing pubsub attributes" in r.data
 
 
-def test_new_source_event_processed(client):
+def test_non_teamcity_event_ignored(client):
     data = json.dumps({"foo": "bar"}).encode("utf-8")
     pubsub_msg = {
         "message": {
@@ -67,14 +73,163 @@ def test_new_source_event_processed(client):
         },
     }
 
-    event = {
-        "event_type": "event_type",
-        "id": "e_id",
-        "metadata": '{"foo": "bar"}',
-        "time_created": 0,
-        "signature": "signature",
-        "msg_id": "foobar",
-        "source": "source",
+    shared.insert_row_into_bigquery = mock.MagicMock()
+
+    r = client.post(
+        "/",
+        data=json.dumps(pubsub_msg),
+        headers={"Content-Type": "application/json"},
+    )
+
+    shared.insert_row_into_bigquery.assert_not_called()
+    assert r.status_code == 204
+
+
+def test_non_teamcity_headers_ignored(client):
+    data = json.dumps({"foo": "bar"}).encode("utf-8")
+    pubsub_msg = {
+        "message": {
+            "data": base64.b64encode(data).decode("utf-8"),
+            "attributes": {"headers": json.dumps({"X-Github-Event": "push"})},
+            "message_id": "foobar",
+        },
+    }
+
+    shared.insert_row_into_bigquery = mock.MagicMock()
+
+    r = client.post(
+        "/",
+        data=json.dumps(pubsub_msg),
+        headers={"Content-Type": "application/json"},
+    )
+
+    shared.insert_row_into_bigquery.assert_not_called()
+    assert r.status_code == 204
+
+
+@pytest.mark.parametrize("headers", ["not json", "5"])
+def test_malformed_headers_ignored(client, headers):
+    pubsub_msg = {
+        "message": {
+            "data": base64.b64encode(b"{}").decode("utf-8"),
+            "attributes": {"headers": headers},
+            "message_id": "foobar",
+        },
+    }
+
+    shared.insert_row_into_bigquery = mock.MagicMock()
+
+    r = client.post(
+        "/",
+        data=json.dumps(pubsub_msg),
+        headers={"Content-Type": "application/json"},
+    )
+
+    shared.insert_row_into_bigquery.assert_not_called()
+    assert r.status_code == 204
+
+
+def test_teamcity_event_inserted(client):
+    build = {"build": {"notifyType": "buildFinished", "buildId": 42, "changes": []}}
+    pubsub_msg = {
+        "message": {
+            "data": base64.b64encode(json.dumps(build).encode("utf-8")).decode("utf-8"),
+            "attributes": {"headers": json.dumps({"X-Tcwebhooks-Request-Id": "foo"})},
+            "message_id": "foobar",
+            "publishTime": 0,
+        },
+    }
+
+    shared.insert_row_into_bigquery = mock.MagicMock()
+
+    r = client.post(
+        "/",
+        data=json.dumps(pubsub_msg),
+        headers={"Content-Type": "application/json"},
+    )
+
+    shared.insert_row_into_bigquery.assert_called_once()
+    assert shared.insert_row_into_bigquery.call_args[0][0]["id"] == 42
+    assert r.status_code == 204
+
+
+def test_teamcity_event_processed():
+    build = {
+        "build": {
+            "notifyType": "buildFinished",
+            "buildId": 42,
+            "buildStatusHtml": "<span>Success</span>",
+            "projectName": "fourkeys",
+            "buildResult": {"status": "SUCCESS", "tests": [1, 2]},
+            "artifacts": [{"name": "app.zip"}, "log.txt"],
+            "changes": [
+                {"version": "abc", "change": {"vcsRoot": "fourkeys"}},
+                {"version": "def", "change": {"vcsRoot": "deployments"}},
+            ],
+        }
+    }
+    msg = {
+        "data": base64.b64encode(json.dumps(build).encode("utf-8")).decode("utf-8"),
+        "attributes": {"headers": json.dumps({"X-Tcwebhooks-Request-Id": "foo"})},
+        "message_id": "foobar",
+        "publishTime": 0,
+    }
+
+    teamcity_event = main.process_teamcity_event(msg)
+
+    assert teamcity_event["event_type"] == "deployment"
+    assert teamcity_event["id"] == 42
+    assert teamcity_event["source"] == "teamcity"
+    assert json.loads(teamcity_event["metadata"]) == {
+        "notifyType": "buildFinished",
+        "buildId": 42,
+        "projectName": "fourkeys",
+        "buildResult": {"status": "SUCCESS", "tests": [1, 2]},
+        "artifacts": [{"name": "app.zip"}, "log.txt"],
+        "changes": ["abc"],
+    }
+
+
+def test_teamcity_unsupported_event():
+    build = {"build": {"notifyType": "buildStarted", "buildId": 42}}
+    msg = {
+        "data": base64.b64encode(json.dumps(build).encode("utf-8")).decode("utf-8"),
+        "attributes": {"headers": json.dumps({"X-Tcwebhooks-Request-Id": "foo"})},
+        "message_id": "foobar",
+        "publishTime": 0,
+    }
+
+    with mock.patch.object(main, "_get_parser") as get_parser:
+        assert main.process_teamcity_event(msg) is None
+
+    get_parser.assert_not_called()
+
+
+def test_teamcity_event_trailing_whitespace():
+    build = {"build": {"notifyType": "buildFinished", "buildId": 42, "changes": []}}
+    data = (json.dumps(build) + "\r\n").encode("utf-8")
+    msg = {
+        "data": base64.b64encode(data).decode("utf-8"),
+        "attributes": {"headers": json.dumps({"X-Tcwebhooks-Request-Id": "foo"})},
+        "message_id": "foobar",
+        "publishTime": 0,
+    }
+
+    teamcity_event = main.process_teamcity_event(msg)
+
+    assert teamcity_event["id"] == 42
+
+
+def test_teamcity_unsupported_notify_type_ignored(client, capsys):
+    # Mentions buildFinished, but is not a buildFinished event
+    build = {"build": {"notifyType": "buildStarted", "text": "buildFinished"}}
+    pubsub_msg = {
+        "message": {
+            "data": base64.b64encode(json.dumps(build).encode("utf-8")).decode("utf-8"),
+            "attributes": {"headers": json.dumps({"X-Tcwebhooks-Request-Id": "foo"})},
+            "message_id": "foobar",
+            "publishTime": 0,
+        },
     }
 
     shared.insert_row_into_bigquery = mock.MagicMock()
@@ -85,5 +240,6 @@ def test_new_source_event_processed(client):
         headers={"Content-Type": "application/json"},
     )
 
-    shared.insert_row_into_bigquery.assert_called_with(event)
+    shared.insert_row_into_bigquery.assert_not_called()
+    assert "WARNING" not in capsys.readouterr().out
     assert r.status_code == 204
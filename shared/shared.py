@@ -16,33 +16,42 @@ import json
 
 from google.cloud import bigquery
 
+# Reused across requests; created on first use so that importing this
+# module does not require credentials
+_client = None
+
+
+def get_bigquery_client():
+    global _client
+    if _client is None:
+        _client = bigquery.Client()
+    return _client
+
 
 def insert_row_into_bigquery(event):
     if not event:
         raise Exception("No data to insert")
 
     # Set up bigquery instance
-    client = bigquery.Client()
+    client = get_bigquery_client()
     dataset_id = "four_keys"
     table_id = "events_raw"
 
     if is_unique(client, event["signature"]):
-        table_ref = client.dataset(dataset_id).table(table_id)
-        table = client.get_table(table_ref)
-
-        # Insert row
+        # Insert row by table ID, which avoids a get_table round trip
+        table = "%s.%s" % (dataset_id, table_id)
         row_to_insert = [
-            (
-                event["event_type"],
-                event["id"],
-                event["metadata"],
-                event["time_created"],
-                event["signature"],
-                event["msg_id"],
-                event["source"],
-            )
+            {
+                "event_type": event["event_type"],
+                "id": event["id"],
+                "metadata": event["metadata"],
+                "time_created": event["time_created"],
+                "signature": event["signature"],
+                "msg_id": event["msg_id"],
+                "source": event["source"],
+            }
         ]
-        bq_errors = client.insert_rows(table, row_to_insert)
+        bq_errors = client.insert_rows_json(table, row_to_insert)
 
         # If errors, log to Stackdriver
         if bq_errors:
@@ -56,8 +65,13 @@ def insert_row_into_bigquery(event):
 
 
 def is_unique(client, signature):
-    sql = "SELECT signature FROM four_keys.events_raw WHERE signature = '%s'"
-    query_job = client.query(sql % signature)
+    sql = "SELECT signature FROM four_keys.events_raw WHERE signature = @signature"
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=[
+            bigquery.ScalarQueryParameter("signature", "STRING", signature),
+        ]
+    )
+    query_job = client.query(sql, job_config=job_config)
     results = query_job.result()
     return not results.total_rows
 
@@ -0,0 +1,75 @@
+# Copyright 2020 Google, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import shared
+
+import mock
+import pytest
+
+
+@pytest.fixture
+def client():
+    client = mock.MagicMock()
+    with mock.patch.object(shared, "_client", None), mock.patch.object(
+        shared.bigquery, "Client", return_value=client
+    ):
+        yield client
+
+
+def test_insert_row_into_bigquery(client):
+    client.query.return_value.result.return_value.total_rows = 0
+    client.insert_rows_json.return_value = []
+
+    event = {
+        "event_type": "event_type",
+        "id": "e_id",
+        "metadata": '{"foo": "bar"}',
+        "time_created": 0,
+        "signature": "signature",
+        "msg_id": "foobar",
+        "source": "source",
+    }
+
+    shared.insert_row_into_bigquery(event)
+
+    client.insert_rows_json.assert_called_once_with("four_keys.events_raw", [event])
+    client.get_table.assert_not_called()
+
+
+def test_insert_row_into_bigquery_duplicate(client):
+    client.query.return_value.result.return_value.total_rows = 1
+
+    shared.insert_row_into_bigquery({"signature": "signature"})
+
+    client.insert_rows_json.assert_not_called()
+
+
+def test_is_unique_uses_query_parameter(client):
+    client.query.return_value.result.return_value.total_rows = 0
+
+    assert shared.is_unique(client, "signature")
+
+    sql = client.query.call_args[0][0]
+    job_config = client.query.call_args[1]["job_config"]
+    (param,) = job_config.query_parameters
+    assert "@signature" in sql
+    assert isinstance(param, shared.bigquery.ScalarQueryParameter)
+    assert (param.name, param.type_, param.value) == ("signature", "STRING", "signature")
+
+
+def test_bigquery_client_created_once(client):
+    assert shared.get_bigquery_client() is client
+    assert shared.get_bigquery_client() is client
+
+    shared.bigquery.Client.assert_called_once_with()